@@ -1,4 +1,3 @@
-import yaml
 import argparse
 import csv
 
@@ -12,6 +11,7 @@ from mlpf.model.utils import (
     count_parameters,
     ELEM_TYPES_NONZERO,
 )
+from mlpf.utils import load_config
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config", "-c", type=str, default=None, help="yaml config")
@@ -24,8 +24,7 @@ parser.add_argument(
 )
 args = parser.parse_args()
 
-with open(args.config, "r") as stream:  # load config (includes: which physics samples, model params)
-    config = yaml.safe_load(stream)
+config = load_config(args.config)
 
 
 nconvs_width_list = [
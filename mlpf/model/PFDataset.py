@@ -158,6 +158,13 @@ class PFBatch:
             attrs[attr] = this_attr.to(device, **kwargs)
         return PFBatch(**attrs)
 
+    # called by the DataLoader when pin_memory=True, so that the non_blocking host to device copies are asynchronous
+    def pin_memory(self):
+        attrs = {}
+        for attr in self.attrs:
+            attrs[attr] = getattr(self, attr).pin_memory()
+        return PFBatch(**attrs)
+
 
 # pads items with variable lengths (seq_len1, seq_len2, ...) to [batch, max(seq_len), ...]
 class Collater:
@@ -186,18 +193,14 @@ class InterleavedIterator(object):
         self.idx = 0
         self.data_loaders = data_loaders
         self.data_loaders_iter = [iter(dl) for dl in data_loaders]
-        max_loader_size = max([len(dl) for dl in data_loaders])
-
-        self.loader_ds_indices = []
+        loader_sizes = np.array([len(dl) for dl in data_loaders])
 
-        # iterate loaders interleaved
-        for i in range(max_loader_size):
-            for iloader, loader in enumerate(data_loaders):
-                if i < len(loader):
-                    self.loader_ds_indices.append(iloader)
+        # iterate loaders interleaved: step i takes one batch from each loader that has more than i batches,
+        # the column indices of the (step, loader) availability grid in row-major order give exactly this sequence
+        available = np.arange(loader_sizes.max())[:, None] < loader_sizes[None, :]
+        self.loader_ds_indices = np.nonzero(available)[1].tolist()
 
         self.cur_index = 0
-        self._len = None
 
     def __iter__(self):
         return self
@@ -214,15 +217,8 @@ class InterleavedIterator(object):
         return next(self.data_loaders_iter[iloader])
 
     def __len__(self):
-        if self._len:
-            return self._len
-        else:
-            # compute and cache the length
-            len_ = 0
-            for iloader in range(len(self.data_loaders_iter)):
-                len_ += len(self.data_loaders_iter[iloader])
-            self._len = len_
-            return len_
+        # the interleaved indices hold exactly one entry per batch of each loader
+        return len(self.loader_ds_indices)
 
 
 def set_worker_sharing_strategy(worker_id: int) -> None:
@@ -277,8 +273,10 @@ def get_interleaved_dataloaders(world_size, rank, config, use_cuda, use_ray):
                 sampler=sampler,
                 num_workers=config["num_workers"],
                 prefetch_factor=config["prefetch_factor"],
-                # pin_memory=use_cuda,
-                # pin_memory_device="cuda:{}".format(rank) if use_cuda else "",
+                # keep the workers (and their prefetched batches) alive across epochs instead of respawning them
+                persistent_workers=config["num_workers"] > 0,
+                # pinned batches let batch.to(rank, non_blocking=True) overlap the copy with compute
+                pin_memory=use_cuda,
                 drop_last=True,
                 worker_init_fn=set_worker_sharing_strategy,
             )
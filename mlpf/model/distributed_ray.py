@@ -232,6 +232,9 @@ def train_ray_trial(config, args, outdir=None):
     }
     model = MLPF(**model_kwargs)
 
+    if config["compile"]:
+        model.compile(dynamic=True)
+
     if world_size > 1:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
     # optimizer should be created after distributing the model to devices with ray.train.torch.prepare_model(model)
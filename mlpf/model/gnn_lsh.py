@@ -33,14 +33,20 @@ def point_wise_feed_forward_network(
     return nn.Sequential(*layers)
 
 
-def split_indices_to_bins_batch(cmul, nbins, bin_size, msk, stable_sort=False):
-    a = torch.argmax(cmul, axis=-1)
+def split_indices_to_bins_batch(mul, nbins, bin_size, msk, stable_sort=False):
+    # equivalent to argmax(concat([mul, -mul])), without materializing the concatenated projection:
+    # the maximum of -mul is at the minimum of mul, ties are resolved towards the first half as in argmax
+    a = torch.where(
+        torch.amax(mul, axis=-1) >= -torch.amin(mul, axis=-1),
+        torch.argmax(mul, axis=-1),
+        torch.argmin(mul, axis=-1) + mul.shape[-1],
+    )
 
     # This gives a CUDA error for some reason
     # b = torch.where(~msk, nbins - 1, 0)
     # b = b.to(torch.int64)
 
-    b = torch.zeros(msk.shape, dtype=torch.int64, device=cmul.device)
+    b = torch.zeros(msk.shape, dtype=torch.int64, device=mul.device)
     # JP: check if this should be ~msk or msk (both here and in the TF implementation)
     b[~msk] = nbins - 1
 
@@ -50,13 +56,19 @@ def split_indices_to_bins_batch(cmul, nbins, bin_size, msk, stable_sort=False):
     else:
         # for ONNX export to work, stable must not be provided at all as an argument
         bins_split = torch.argsort(bin_idx)
-    bins_split = bins_split.reshape((cmul.shape[0], nbins, bin_size))
-    return bins_split
+
+    # the inverse permutation, used to undo the binning, is a scatter of the positions rather than a second argsort
+    positions = torch.arange(bins_split.shape[-1], device=bins_split.device).expand(bins_split.shape)
+    inv_bins_split = torch.scatter(torch.empty_like(bins_split), 1, bins_split, positions)
+
+    bins_split = bins_split.reshape((mul.shape[0], nbins, bin_size))
+    return bins_split, inv_bins_split
 
 
 def pairwise_l2_dist(A, B):
     na = torch.sum(torch.square(A), -1)
-    nb = torch.sum(torch.square(B), -1)
+    # the kernel computes the distances of the points to themselves, in that case the norms are shared
+    nb = na if B is A else torch.sum(torch.square(B), -1)
 
     # na as a row and nb as a column vectors
     na = torch.unsqueeze(na, -1)
@@ -64,7 +76,16 @@ def pairwise_l2_dist(A, B):
 
     # return pairwise euclidean difference matrix
     # note that this matrix multiplication can go out of range for float16 in case the absolute values of A and B are large
-    D = torch.sqrt(torch.clip(na - 2 * torch.matmul(A, torch.transpose(B, -1, -2)) + nb, 1e-6, 1e6))
+    # baddbmm computes (na + nb) - 2 * A @ B^T as a single batched GEMM, it needs 3D inputs so flatten the leading dims
+    shp = A.shape[:-2] + (A.shape[-2], B.shape[-2])
+    D2 = torch.baddbmm(
+        torch.reshape(na + nb, (-1, shp[-2], shp[-1])),
+        torch.reshape(A, (-1, A.shape[-2], A.shape[-1])),
+        # .mT is a strided view, the GEMM reads B as transposed without copying it
+        torch.reshape(B, (-1, B.shape[-2], B.shape[-1])).mT,
+        alpha=-2,
+    )
+    D = torch.sqrt(torch.clip(torch.reshape(D2, shp), 1e-6, 1e6))
     return D
 
 
@@ -102,19 +123,25 @@ class GHConvDense(nn.Module):
             in_degrees = torch.sum(torch.abs(adj), axis=-1)
 
             # add epsilon to prevent numerical issues from 1/sqrt(x)
-            norm = torch.unsqueeze(torch.pow(in_degrees + 1e-6, -0.5), -1) * msk
+            norm = torch.unsqueeze(torch.rsqrt(in_degrees + 1e-6), -1) * msk
+
+        # compute the homogeneous, heterogeneous and gate projections with a single matmul on the concatenated weights
+        # masked rows of x are zero, so f_hom and f_het are masked already, and the gate only affects
+        # rows that are masked in the output
+        f_all = torch.linalg.matmul(x * msk, torch.cat([self.theta, self.W_h, self.W_t], axis=-1))
+        f_hom, f_het, gate = torch.split(f_all, self.output_dim, dim=-1)
 
-        f_hom = torch.linalg.matmul(x * msk, self.theta) * msk
         if self.normalize_degrees:
             f_hom = torch.linalg.matmul(adj, f_hom * norm) * norm
         else:
             f_hom = torch.linalg.matmul(adj, f_hom)
 
-        f_het = torch.linalg.matmul(x * msk, self.W_h)
-        gate = torch.sigmoid(torch.linalg.matmul(x, self.W_t) + self.b_t)
+        gate = torch.sigmoid(gate + self.b_t)
 
+        # f_hom and f_het are zero on the masked rows (the adjacency is masked row-wise by the graph builder),
+        # so out is already masked and the activation keeps it so, as act(0) == 0
         out = gate * f_hom + (1.0 - gate) * f_het
-        return self.activation(out) * msk
+        return self.activation(out)
 
 
 class NodePairGaussianKernel(nn.Module):
@@ -138,41 +165,45 @@ class NodePairGaussianKernel(nn.Module):
     def forward(self, x_msg_binned, msk, training=False):
         x = x_msg_binned * msk
         dm = torch.unsqueeze(self.dist_norm(x, x), axis=-1)
+        # the distances are non-negative, so the kernel is already bounded from above by 1
         dm = torch.exp(-self.dist_mult * dm)
-        dm = torch.clip(dm, self.clip_value_low, 1)
+        dm = torch.clamp(dm, min=self.clip_value_low)
         return dm
 
 
-def split_msk_and_msg(bins_split, cmul, x_msg, x_node, msk, n_bins, bin_size):
-    bins_split_2 = torch.reshape(bins_split, (bins_split.shape[0], bins_split.shape[1] * bins_split.shape[2]))
+def split_msk_and_msg(bins_split, x_msg, x_node, msk, n_bins, bin_size):
+    n_batches = x_msg.shape[0]
+    n_points = n_bins * bin_size
+    n_msg_features = x_msg.shape[-1]
+    n_node_features = x_node.shape[-1]
+
+    bins_split_2 = torch.reshape(bins_split, (n_batches, n_points))
 
-    bins_split_3 = torch.unsqueeze(bins_split_2, axis=-1).expand(bins_split_2.shape[0], bins_split_2.shape[1], x_msg.shape[-1])
+    bins_split_3 = torch.unsqueeze(bins_split_2, axis=-1).expand(n_batches, n_points, n_msg_features)
     x_msg_binned = torch.gather(x_msg, 1, bins_split_3)
-    x_msg_binned = torch.reshape(x_msg_binned, (cmul.shape[0], n_bins, bin_size, x_msg_binned.shape[-1]))
+    x_msg_binned = torch.reshape(x_msg_binned, (n_batches, n_bins, bin_size, n_msg_features))
 
-    bins_split_3 = torch.unsqueeze(bins_split_2, axis=-1).expand(bins_split_2.shape[0], bins_split_2.shape[1], x_node.shape[-1])
+    bins_split_3 = torch.unsqueeze(bins_split_2, axis=-1).expand(n_batches, n_points, n_node_features)
     x_features_binned = torch.gather(x_node, 1, bins_split_3)
-    x_features_binned = torch.reshape(x_features_binned, (cmul.shape[0], n_bins, bin_size, x_features_binned.shape[-1]))
+    x_features_binned = torch.reshape(x_features_binned, (n_batches, n_bins, bin_size, n_node_features))
 
     msk_f_binned = torch.gather(msk, 1, bins_split_2)
-    msk_f_binned = torch.reshape(msk_f_binned, (cmul.shape[0], n_bins, bin_size, 1))
+    msk_f_binned = torch.reshape(msk_f_binned, (n_batches, n_bins, bin_size, 1))
     return x_msg_binned, x_features_binned, msk_f_binned
 
 
-def reverse_lsh(bins_split, points_binned_enc):
+def reverse_lsh(inv_bins_split, points_binned_enc):
     shp = points_binned_enc.shape
     batch_dim = shp[0]
     n_points = shp[1] * shp[2]
     n_features = shp[-1]
 
-    bins_split_flat = torch.reshape(bins_split, (batch_dim, n_points))
     points_binned_enc_flat = torch.reshape(points_binned_enc, (batch_dim, n_points, n_features))
 
-    ret = torch.zeros(batch_dim, n_points, n_features, device=points_binned_enc.device)
-    for ibatch in range(batch_dim):
-        # torch._assert(torch.min(bins_split_flat[ibatch]) >= 0, "reverse_lsh n_points min")
-        # torch._assert(torch.max(bins_split_flat[ibatch]) < n_points, "reverse_lsh n_points max")
-        ret[ibatch][bins_split_flat[ibatch]] = points_binned_enc_flat[ibatch]
+    # bins_split is a permutation of the points, so undoing the binning is a gather with the inverse permutation,
+    # which may be truncated to gather only the leading (unpadded) points
+    inv_bins_split = torch.unsqueeze(inv_bins_split, axis=-1).expand(batch_dim, inv_bins_split.shape[1], n_features)
+    ret = torch.gather(points_binned_enc_flat, 1, inv_bins_split)
     return ret
 
 
@@ -194,40 +225,36 @@ class MessageBuildingLayerLSH(nn.Module):
         )
 
     def forward(self, x_msg, x_node, msk, training=False):
-        shp = x_msg.shape
-        n_points = torch.tensor(shp[1])
+        # the shapes are static python ints, no need to create tensors (and device ops) for them
+        n_points = x_msg.shape[1]
 
         if n_points % self.bin_size != 0:
             raise Exception("Number of elements per event must be exactly divisible by the bin size")
 
         # compute the number of LSH bins to divide the input points into on the fly
         # n_points must be divisible by bin_size exactly due to the use of reshape
-        n_bins = torch.floor_divide(n_points, self.bin_size)
+        n_bins = n_points // self.bin_size
 
-        mul = torch.linalg.matmul(
-            x_msg,
-            self.codebook_random_rotations[:, : torch.maximum(torch.tensor(1), n_bins // 2)],
-        )
-        cmul = torch.concatenate([mul, -mul], axis=-1)
-        bins_split = split_indices_to_bins_batch(cmul, n_bins, self.bin_size, msk, self.stable_sort)
+        # only the argmax of the LSH projection is used, which is not differentiable, so skip building the autograd graph.
+        # the projection stays in the input (or autocast) precision: the argmax over near-ties changes the bins of some points
+        # at lower precision, which would make the graph differ between e.g. float32 GPU training and CPU inference
+        with torch.no_grad():
+            mul = torch.linalg.matmul(x_msg, self.codebook_random_rotations[:, : max(1, n_bins // 2)])
+        bins_split, inv_bins_split = split_indices_to_bins_batch(mul, n_bins, self.bin_size, msk, self.stable_sort)
 
         # replaced tf.gather with torch.vmap, indexing and reshape
-        x_msg_binned, x_features_binned, msk_f_binned = split_msk_and_msg(bins_split, cmul, x_msg, x_node, msk, n_bins, self.bin_size)
+        x_msg_binned, x_features_binned, msk_f_binned = split_msk_and_msg(bins_split, x_msg, x_node, msk, n_bins, self.bin_size)
 
         # Run the node-to-node kernel (distance computation / graph building / attention)
         dm = self.kernel(x_msg_binned, msk_f_binned, training=training)
 
         # remove the masked points row-wise and column-wise
-        msk_f_binned_squeeze = torch.squeeze(msk_f_binned, axis=-1)
-        shp_dm = dm.shape
-        rshp_row = [shp_dm[0], shp_dm[1], shp_dm[2], 1, 1]
-        rshp_col = [shp_dm[0], shp_dm[1], 1, shp_dm[3], 1]
-        msk_row = torch.reshape(msk_f_binned_squeeze, rshp_row).to(dm.dtype)
-        msk_col = torch.reshape(msk_f_binned_squeeze, rshp_col).to(dm.dtype)
-        dm = torch.multiply(dm, msk_row)
-        dm = torch.multiply(dm, msk_col)
+        # the outer product of the (small) masks is formed first, so that the large dm tensor is only multiplied once
+        msk_f_binned_squeeze = torch.squeeze(msk_f_binned, axis=-1).to(dm.dtype)
+        msk_2d = torch.unsqueeze(msk_f_binned_squeeze, -1) * torch.unsqueeze(msk_f_binned_squeeze, -2)
+        dm = torch.multiply(dm, torch.unsqueeze(msk_2d, -1))
 
-        return bins_split, x_features_binned, dm, msk_f_binned
+        return bins_split, inv_bins_split, x_features_binned, dm, msk_f_binned
 
 
 class CombinedGraphLayer(nn.Module):
@@ -274,14 +301,12 @@ class CombinedGraphLayer(nn.Module):
 
     def forward(self, x, msk):
         n_elems = x.shape[1]
-        bins_to_pad_to = -torch.floor_divide(-n_elems, self.bin_size)
+        bins_to_pad_to = -(-n_elems // self.bin_size)
+        n_pad = bins_to_pad_to * self.bin_size - n_elems
 
         # pad the element dimension
-        pad_size = (0, 0, 0, bins_to_pad_to * self.bin_size - n_elems)
-        x = torch.nn.functional.pad(x, pad_size)
-
-        pad_size = (0, bins_to_pad_to * self.bin_size - n_elems)
-        msk = torch.nn.functional.pad(msk, pad_size, value=True)
+        x = torch.nn.functional.pad(x, (0, 0, 0, n_pad))
+        msk = torch.nn.functional.pad(msk, (0, n_pad), value=True)
 
         if self.do_layernorm:
             x = self.layernorm1(x)
@@ -290,7 +315,8 @@ class CombinedGraphLayer(nn.Module):
         x_dist = self.dist_activation(self.ffn_dist(x))
 
         # compute the element-to-element messages / distance matrix / graph structure
-        bins_split, x, dm, msk_f = self.message_building_layer(x_dist, x, msk)
+        # the binning is computed once and shared by all the message passing layers
+        bins_split, inv_bins_split, x, dm, msk_f = self.message_building_layer(x_dist, x, msk)
 
         # run the node update with message passing
         for msg in self.message_passing_layers:
@@ -299,7 +325,9 @@ class CombinedGraphLayer(nn.Module):
             if self.dropout_layer:
                 x = self.dropout_layer(x)
 
-        # undo the binning according to the element-to-bin indices
-        x = reverse_lsh(bins_split, x)
+        # undo the binning according to the element-to-bin indices, gathering only the unpadded elements.
+        # index_select instead of slicing, as a slice would make torch.compile specialize on whether any padding was added
+        inv_bins_split = torch.index_select(inv_bins_split, 1, torch.arange(n_elems, device=inv_bins_split.device))
+        x = reverse_lsh(inv_bins_split, x)
 
-        return x[:, :n_elems, :]
+        return x
@@ -47,14 +47,10 @@ def predict_one_batch(conv_type, model, i, batch, rank, jetdef, jet_ptcut, jet_m
     # convert all outputs to float32 in case running in float16 or bfloat16
     ypred = tuple([y.to(torch.float32) for y in ypred])
 
-    # transform log (pt/elempt) -> pt
+    # transform log (pt/elempt) -> pt and log (E/elemE) -> E in one pass over both columns
     pred_cls = torch.argmax(ypred[0], axis=-1)
-    ypred[2][..., 0] = torch.exp(ypred[2][..., 0]) * batch.X[..., 1]
-    ypred[2][..., 0][pred_cls == 0] = 0
-
-    # transform log (E/elemE) -> E
-    ypred[2][..., 4] = torch.exp(ypred[2][..., 4]) * batch.X[..., 5]
-    ypred[2][..., 4][pred_cls == 0] = 0
+    pred_pt_e = torch.exp(ypred[2][..., [0, 4]]) * batch.X[..., [1, 5]]
+    ypred[2][..., [0, 4]] = torch.where(torch.unsqueeze(pred_cls != 0, -1), pred_pt_e, 0.0)
 
     batch.ytarget[..., 2] = batch.ytarget_pt_orig
     batch.ytarget[..., 6] = batch.ytarget_e_orig
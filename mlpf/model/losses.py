@@ -9,15 +9,15 @@ from mlpf.model.logger import _logger
 
 def sliced_wasserstein_loss(y_pred, y_true, num_projections=200):
     # create normalized random basis vectors
-    theta = torch.randn(num_projections, y_true.shape[-1]).to(device=y_true.device)
-    theta = theta / torch.sqrt(torch.sum(theta**2, axis=1, keepdims=True))
+    theta = torch.nn.functional.normalize(torch.randn(num_projections, y_true.shape[-1], device=y_true.device), dim=1)
 
     # project the features with the random basis
     A = torch.matmul(y_true, torch.transpose(theta, -1, -2))
     B = torch.matmul(y_pred, torch.transpose(theta, -1, -2))
 
-    A_sorted = torch.sort(A, axis=-2).values
-    B_sorted = torch.sort(B, axis=-2).values
+    # sort the true and predicted projections in a single call
+    # under autocast the projections, and therefore the sort, are already in the reduced precision
+    A_sorted, B_sorted = torch.sort(torch.stack([A, B]), axis=-2).values
 
     ret = torch.sqrt(torch.sum(torch.pow(A_sorted - B_sorted, 2), axis=[-1, -2]))
     return ret
@@ -33,10 +33,15 @@ def mlpf_loss(y, ypred, batch):
     loss = {}
     loss_obj_id = FocalLoss(gamma=2.0, reduction="none")
 
+    # the element masks are used many times below, compute them once
+    is_true_particle = y["cls_id"] != 0
+    # losses that are only computed for true particles on elements that are not padded
+    msk_loss_particle = is_true_particle & batch.mask
+
     msk_pred_particle = torch.unsqueeze((ypred["cls_id"] != 0).to(dtype=torch.float32), axis=-1)
-    msk_true_particle = torch.unsqueeze((y["cls_id"] != 0).to(dtype=torch.float32), axis=-1)
+    msk_true_particle = torch.unsqueeze(is_true_particle.to(dtype=torch.float32), axis=-1)
     nelem = torch.sum(batch.mask)
-    npart = torch.sum(y["cls_id"] != 0)
+    npart = torch.sum(is_true_particle)
 
     ypred["momentum"] = ypred["momentum"] * msk_true_particle
     y["momentum"] = y["momentum"] * msk_true_particle
@@ -47,16 +52,14 @@ def mlpf_loss(y, ypred, batch):
     ypred["ispu"] = ypred["ispu"].permute((0, 2, 1))
 
     # binary loss for particle / no-particle classification
-    # loss_binary_classification = loss_obj_id(ypred["cls_binary"], (y["cls_id"] != 0).long()).reshape(y["cls_id"].shape)
-    loss_binary_classification = 10 * torch.nn.functional.cross_entropy(ypred["cls_binary"], (y["cls_id"] != 0).long(), reduction="none")
+    # loss_binary_classification = loss_obj_id(ypred["cls_binary"], is_true_particle.long()).reshape(y["cls_id"].shape)
+    loss_binary_classification = 10 * torch.nn.functional.cross_entropy(ypred["cls_binary"], is_true_particle.long(), reduction="none")
 
     # compare the particle type, only for cases where there was a true particle
     loss_pid_classification = loss_obj_id(ypred["cls_id_onehot"], y["cls_id"]).reshape(y["cls_id"].shape)
-    loss_pid_classification[y["cls_id"] == 0] *= 0
 
     # compare particle "PU-ness", only for cases where there was a true particle
     loss_pu = torch.nn.functional.binary_cross_entropy_with_logits(torch.squeeze(ypred["ispu"], dim=1), y["ispu"], reduction="none")
-    loss_pu[y["cls_id"] == 0] *= 0
 
     # compare particle momentum, only for cases where there was a true particle
     loss_regression_pt = torch.nn.functional.mse_loss(ypred["pt"], y["pt"], reduction="none")
@@ -65,21 +68,16 @@ def mlpf_loss(y, ypred, batch):
     loss_regression_cos_phi = 1e-2 * torch.nn.functional.mse_loss(ypred["cos_phi"], y["cos_phi"], reduction="none")
     loss_regression_energy = torch.nn.functional.mse_loss(ypred["energy"], y["energy"], reduction="none")
 
-    loss_regression_pt[y["cls_id"] == 0] *= 0
-    loss_regression_eta[y["cls_id"] == 0] *= 0
-    loss_regression_sin_phi[y["cls_id"] == 0] *= 0
-    loss_regression_cos_phi[y["cls_id"] == 0] *= 0
-    loss_regression_energy[y["cls_id"] == 0] *= 0
-
-    # set the loss to 0 on padded elements in the batch
-    loss_binary_classification[batch.mask == 0] *= 0
-    loss_pid_classification[batch.mask == 0] *= 0
-    loss_pu[batch.mask == 0] *= 0
-    loss_regression_pt[batch.mask == 0] *= 0
-    loss_regression_eta[batch.mask == 0] *= 0
-    loss_regression_sin_phi[batch.mask == 0] *= 0
-    loss_regression_cos_phi[batch.mask == 0] *= 0
-    loss_regression_energy[batch.mask == 0] *= 0
+    # set the loss to 0 on padded elements in the batch, and where there was no true particle for the particle losses
+    # multiply by the masks rather than boolean-index writes, which are dynamic-shape scatters with a device sync
+    loss_binary_classification = loss_binary_classification * batch.mask
+    loss_pid_classification = loss_pid_classification * msk_loss_particle
+    loss_pu = loss_pu * msk_loss_particle
+    loss_regression_pt = loss_regression_pt * msk_loss_particle
+    loss_regression_eta = loss_regression_eta * msk_loss_particle
+    loss_regression_sin_phi = loss_regression_sin_phi * msk_loss_particle
+    loss_regression_cos_phi = loss_regression_cos_phi * msk_loss_particle
+    loss_regression_energy = loss_regression_energy * msk_loss_particle
 
     # add weight based on target pt
     sqrt_target_pt = torch.sqrt(torch.exp(y["pt"]) * batch.X[:, :, 1])
@@ -100,21 +98,21 @@ def mlpf_loss(y, ypred, batch):
 
     # compute predicted pt from model output
     pred_pt = torch.unsqueeze(torch.exp(ypred["pt"]) * batch.X[..., 1], axis=-1) * msk_pred_particle
-    pred_px = pred_pt * torch.unsqueeze(ypred["cos_phi"].detach(), axis=-1) * msk_pred_particle
-    pred_py = pred_pt * torch.unsqueeze(ypred["sin_phi"].detach(), axis=-1) * msk_pred_particle
+    # px, py in one multiply, pred_pt is already masked
+    pred_pxpy = pred_pt * torch.stack([ypred["cos_phi"], ypred["sin_phi"]], axis=-1).detach()
     # pred_pz = pred_pt * torch.unsqueeze(torch.sinh(ypred["eta"].detach()), axis=-1) * msk_pred_particle
     # pred_mass2 = pred_e**2 - pred_pt**2 - pred_pz**2
 
     # compute MET, sum across particle axis in event
-    pred_met = torch.sqrt(torch.sum(pred_px, axis=-2) ** 2 + torch.sum(pred_py, axis=-2) ** 2).detach()
-    loss["MET"] = torch.nn.functional.huber_loss(pred_met.squeeze(dim=-1), batch.genmet).mean()
+    pred_met = torch.linalg.vector_norm(torch.sum(pred_pxpy, axis=-2), dim=-1).detach()
+    loss["MET"] = torch.nn.functional.huber_loss(pred_met, batch.genmet).mean()
 
     was_input_pred = torch.concat([torch.softmax(ypred["cls_binary"].transpose(1, 2), axis=-1), ypred["momentum"]], axis=-1) * batch.mask.unsqueeze(
         axis=-1
     )
-    was_input_true = torch.concat([torch.nn.functional.one_hot((y["cls_id"] != 0).to(torch.long)), y["momentum"]], axis=-1) * batch.mask.unsqueeze(
-        axis=-1
-    )
+    # binary one-hot built directly in the target dtype instead of an int64 one_hot promoted by the concat
+    is_true_onehot = torch.stack([~is_true_particle, is_true_particle], axis=-1).to(dtype=y["momentum"].dtype)
+    was_input_true = torch.concat([is_true_onehot, y["momentum"]], axis=-1) * batch.mask.unsqueeze(axis=-1)
 
     # standardize Wasserstein loss
     std = was_input_true[batch.mask].std(axis=0)
@@ -193,10 +191,7 @@ class FocalLoss(nn.Module):
             # (N, d1, d2, ..., dK) --> (N * d1 * ... * dK,)
             y = y.view(-1)
 
-        # compute weighted cross entropy term: -alpha * log(pt)
-        # (alpha is already part of self.nll_loss)
         log_p = F.log_softmax(x, dim=-1)
-        ce = self.nll_loss(log_p, y)
 
         # get true class column from each row
         # this is slow due to indexing
@@ -204,6 +199,13 @@ class FocalLoss(nn.Module):
         # log_pt = log_p[all_rows, y]
         log_pt = torch.gather(log_p, 1, y.unsqueeze(axis=-1)).squeeze(axis=-1)
 
+        # compute weighted cross entropy term: -alpha * log(pt)
+        # (alpha is already part of self.nll_loss), without class weights it is just -log(pt)
+        if self.alpha is None:
+            ce = -log_pt
+        else:
+            ce = self.nll_loss(log_p, y)
+
         # compute focal term: (1 - pt)^gamma
         pt = log_pt.exp()
         focal_term = (1 - pt) ** self.gamma
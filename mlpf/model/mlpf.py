@@ -133,10 +133,10 @@ class PreLnSelfAttentionLayer(nn.Module):
         # default path, for FlashAttn/Math backend
         if self.enable_ctx_manager:
             with sdpa_kernel(self.attn_params[self.attention_type]):
-                mha_out = self.mha(q, x, x, need_weights=False, key_padding_mask=key_padding_mask)[0]
+                # the attention weights are only requested when saving them, in which case the same call provides the output
+                mha_out, att_mat = self.mha(q, x, x, need_weights=self.save_attention, key_padding_mask=key_padding_mask)
 
                 if self.save_attention:
-                    att_mat = self.mha(q, x, x, need_weights=True, key_padding_mask=key_padding_mask)[1]
                     att_mat = att_mat.detach().cpu().numpy()
                     np.savez(
                         open("{}/attn_{}.npz".format(self.outdir, self.name), "wb"),
@@ -148,8 +148,7 @@ class PreLnSelfAttentionLayer(nn.Module):
         else:
             mha_out = self.mha(q, x, x, need_weights=False, key_padding_mask=key_padding_mask)[0]
 
-        mha_out = mha_out * mask_
-
+        # the masked rows do not need to be zeroed here: all the following ops are row-wise and the output is masked
         mha_out = x + mha_out
         x = self.norm1(mha_out)
         x = mha_out + self.seq(x)
@@ -168,6 +167,11 @@ def ffn(input_dim, output_dim, width, act, dropout):
     )
 
 
+def elemtype_onehot(elems, elemtypes):
+    # one-hot mask (..., len(elemtypes)) of the element type in the first feature, from a single comparison
+    return elems[..., 0:1] == torch.tensor(elemtypes, device=elems.device)
+
+
 class RegressionOutput(nn.Module):
     def __init__(self, mode, embed_dim, width, act, dropout, elemtypes):
         super(RegressionOutput, self).__init__()
@@ -196,14 +200,14 @@ class RegressionOutput(nn.Module):
             return nn_out
         elif self.mode == "direct-elemtype":
             nn_out = self.nn(x)
-            elemtype_mask = torch.cat([elems[..., 0:1] == elemtype for elemtype in self.elemtypes], axis=-1)
+            elemtype_mask = elemtype_onehot(elems, self.elemtypes)
             nn_out = torch.sum(elemtype_mask * nn_out, axis=-1, keepdims=True)
             return nn_out
         elif self.mode == "direct-elemtype-split":
             elem_outs = []
             for elem in range(len(self.elemtypes)):
                 elem_outs.append(self.nn[elem](x))
-            elemtype_mask = torch.cat([elems[..., 0:1] == elemtype for elemtype in self.elemtypes], axis=-1)
+            elemtype_mask = elemtype_onehot(elems, self.elemtypes)
             elem_outs = torch.cat(elem_outs, axis=-1)
             return torch.sum(elem_outs * elemtype_mask, axis=-1, keepdims=True)
         elif self.mode == "additive":
@@ -218,7 +222,7 @@ class RegressionOutput(nn.Module):
         elif self.mode == "linear-elemtype":
             nn_out1 = self.nn1(x)
             nn_out2 = self.nn2(x)
-            elemtype_mask = torch.cat([elems[..., 0:1] == elemtype for elemtype in self.elemtypes], axis=-1)
+            elemtype_mask = elemtype_onehot(elems, self.elemtypes)
             a = torch.sum(elemtype_mask * nn_out1, axis=-1, keepdims=True)
             b = torch.sum(elemtype_mask * nn_out2, axis=-1, keepdims=True)
             return orig_value * a + b
@@ -382,13 +386,15 @@ class MLPF(nn.Module):
                 embedding_id = self.nn0_id(Xfeat_normed)
                 embedding_reg = self.nn0_reg(Xfeat_normed)
             elif self.input_encoding == "split":
+                # the element type mask is shared by the id and reg encoders, compute it once
+                elemtype_mask = elemtype_onehot(X_features, self.elemtypes_nonzero)
+                elemtype_mask = elemtype_mask.unsqueeze(-2)
+
                 embedding_id = torch.stack([nn0(Xfeat_normed) for nn0 in self.nn0_id], axis=-1)
-                elemtype_mask = torch.cat([X_features[..., 0:1] == elemtype for elemtype in self.elemtypes_nonzero], axis=-1)
-                embedding_id = torch.sum(embedding_id * elemtype_mask.unsqueeze(-2), axis=-1)
+                embedding_id = torch.sum(embedding_id * elemtype_mask, axis=-1)
 
                 embedding_reg = torch.stack([nn0(Xfeat_normed) for nn0 in self.nn0_reg], axis=-1)
-                elemtype_mask = torch.cat([X_features[..., 0:1] == elemtype for elemtype in self.elemtypes_nonzero], axis=-1)
-                embedding_reg = torch.sum(embedding_reg * elemtype_mask.unsqueeze(-2), axis=-1)
+                embedding_reg = torch.sum(embedding_reg * elemtype_mask, axis=-1)
 
             for num, conv in enumerate(self.conv_id):
                 conv_input = embedding_id if num == 0 else embeddings_id[-1]
@@ -403,7 +409,7 @@ class MLPF(nn.Module):
         if self.learned_representation_mode == "concat":
             final_embedding_id = torch.cat(embeddings_id, axis=-1)
         elif self.learned_representation_mode == "last":
-            final_embedding_id = torch.cat([embeddings_id[-1]], axis=-1)
+            final_embedding_id = embeddings_id[-1]
 
         if self.use_pre_layernorm:
             final_embedding_id = self.final_norm_id(final_embedding_id)
@@ -418,7 +424,7 @@ class MLPF(nn.Module):
         if self.learned_representation_mode == "concat":
             final_embedding_reg = torch.cat(embeddings_reg, axis=-1)
         elif self.learned_representation_mode == "last":
-            final_embedding_reg = torch.cat([embeddings_reg[-1]], axis=-1)
+            final_embedding_reg = embeddings_reg[-1]
 
         if self.use_pre_layernorm:
             final_embedding_reg = self.final_norm_reg(final_embedding_reg)
@@ -433,9 +439,9 @@ class MLPF(nn.Module):
         pt_real = torch.exp(preds_pt.detach()) * X_features[..., 1:2]
         pz_real = pt_real * torch.sinh(preds_eta.detach())
         e_real = torch.log(torch.sqrt(pt_real**2 + pz_real**2) / X_features[..., 5:6])
-        e_real[~mask] = 0
-        e_real[torch.isinf(e_real)] = 0
-        e_real[torch.isnan(e_real)] = 0
+        # use elementwise selects instead of in-place boolean indexing, which needs a device sync
+        # and breaks the chain of elementwise ops, so that the epilogue can be fused into a single kernel
+        e_real = torch.where(mask.unsqueeze(-1) & torch.isfinite(e_real), e_real, 0.0)
         preds_energy = e_real + torch.nn.functional.relu(self.nn_energy(X_features, final_embedding_reg, X_features[..., 5:6]))
         preds_momentum = torch.cat([preds_pt, preds_eta, preds_sin_phi, preds_cos_phi, preds_energy], axis=-1)
         return preds_binary_particle, preds_pid, preds_momentum, preds_pu
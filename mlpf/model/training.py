@@ -54,15 +54,13 @@ def configure_model_trainable(model: MLPF, trainable: Union[str, List[str]], is_
             model.eval()
 
             # first set all parameters as non-trainable
-            for param in model.parameters():
-                param.requires_grad = False
+            model.requires_grad_(False)
 
             # now explicitly enable specific layers
             for layer in trainable:
                 layer = getattr(model, layer)
                 layer.train()
-                for param in layer.parameters():
-                    param.requires_grad = True
+                layer.requires_grad_(True)
     else:
         model.eval()
 
@@ -609,6 +607,9 @@ def run(rank, world_size, config, outdir, logfile):
         _configLogger("mlpf", filename=logfile)
 
     use_cuda = rank != "cpu"
+    if use_cuda:
+        # make this rank's gpu current, e.g. for the DataLoader memory pinning thread
+        torch.cuda.set_device(rank)
 
     dtype = getattr(torch, config["dtype"])
     _logger.info("configured dtype={} for autocast".format(dtype))
@@ -701,6 +702,9 @@ def run(rank, world_size, config, outdir, logfile):
     model.to(rank)
     configure_model_trainable(model, config["model"]["trainable"], True)
 
+    if config["compile"]:
+        model.compile(dynamic=True)
+
     if world_size > 1:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[rank])
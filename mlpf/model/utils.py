@@ -159,13 +159,16 @@ Y_FEATURES = [
 
 
 def unpack_target(y, model):
+    # cast once, the features below are views into the same tensor
+    y = y.to(dtype=torch.float32)
+
     ret = {}
     ret["cls_id"] = y[..., 0].long()
-    ret["charge"] = torch.clamp((y[..., 1] + 1).to(dtype=torch.float32), 0, 2)  # -1, 0, 1 -> 0, 1, 2
+    ret["charge"] = torch.clamp(y[..., 1] + 1, 0, 2)  # -1, 0, 1 -> 0, 1, 2
 
     for i, feat in enumerate(Y_FEATURES):
         if i >= 2:  # skip the cls and charge as they are defined above
-            ret[feat] = y[..., i].to(dtype=torch.float32)
+            ret[feat] = y[..., i]
     ret["phi"] = torch.atan2(ret["sin_phi"], ret["cos_phi"])
 
     # do some sanity checks
@@ -175,7 +178,7 @@ def unpack_target(y, model):
     # assert torch.all(ret["energy"] >= 0.0)  # energy
 
     # note ~ momentum = ["pt", "eta", "sin_phi", "cos_phi", "energy"]
-    ret["momentum"] = y[..., 2:7].to(dtype=torch.float32)
+    ret["momentum"] = y[..., 2:7]
     ret["p4"] = torch.cat([ret["pt"].unsqueeze(-1), ret["eta"].unsqueeze(-1), ret["phi"].unsqueeze(-1), ret["energy"].unsqueeze(-1)], axis=-1)
 
     return ret
@@ -8,17 +8,20 @@ import logging
 import os
 from pathlib import Path
 
-# comet needs to be imported before torch
-from comet_ml import OfflineExperiment, Experiment  # noqa: F401, isort:skip
-
+# the threading env vars are only read when the BLAS/OpenMP runtimes are first loaded,
+# so they must be set before comet (which may pull in numpy) and torch are imported
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 os.environ["OMP_NUM_THREADS"] = "1"
+os.environ["MKL_NUM_THREADS"] = "1"
+
+# comet needs to be imported before torch
+from comet_ml import OfflineExperiment, Experiment  # noqa: F401, isort:skip
 
 import yaml
 from mlpf.model.training import device_agnostic_run, override_config
 from mlpf.model.distributed_ray import run_hpo, run_ray_training
 from mlpf.model.PFDataset import SHARING_STRATEGY
-from utils import create_experiment_dir
+from utils import create_experiment_dir, load_config
 
 parser = argparse.ArgumentParser()
 
@@ -76,6 +79,7 @@ parser.add_argument(
     help="data type for training",
     choices=["float32", "float16", "bfloat16"],
 )
+parser.add_argument("--compile", action="store_true", default=None, help="compile the model with torch.compile")
 parser.add_argument(
     "--attention-type",
     type=str,
@@ -130,8 +134,7 @@ def main():
     logging.basicConfig(level=logging.INFO)
     number_gpus = args.gpus if args.gpus > 0 else 1  # will be 1 for both cpu (args.gpu < 1) and single-gpu (1)
         
-    with open(args.config, "r") as stream:  # load config (includes: which physics samples, model params)
-        config = yaml.safe_load(stream)
+    config = load_config(args.config)
 
     # override some options for the pipeline test
     if args.pipeline:
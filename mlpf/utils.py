@@ -4,6 +4,19 @@ import platform
 from pathlib import Path
 from comet_ml import OfflineExperiment, Experiment  # isort:skip
 
+import yaml
+
+try:
+    # use the much faster libyaml parser when available
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+def load_config(config_file):
+    with open(config_file, "r") as stream:  # load config (includes: which physics samples, model params)
+        return yaml.load(stream, Loader=YamlLoader)
+
 
 def create_experiment_dir(prefix=None, suffix=None, experiments_dir="experiments"):
     if prefix is None: